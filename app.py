@@ -6,7 +6,7 @@ Routes are organized in separate blueprint modules in the routes package.
 """
 
 from flask import Flask
-from database import init_database, add_sample_data
+from database import init_database, add_sample_data, close_db_connection
 from routes import register_blueprints
 
 
@@ -29,6 +29,9 @@ def create_app():
     # Register all route blueprints
     register_blueprints(app)
     
+    # Close the per-thread database connection when each request ends
+    app.teardown_appcontext(close_db_connection)
+    
     return app
 
 
@@ -3,23 +3,55 @@ Database module for Library Management System
 Handles all database operations and connections
 """
 
+import atexit
+import calendar
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Dict, List, Optional, Tuple
 
 # Database configuration
 DATABASE = 'library.db'
 
+# One connection per thread, shared by every helper call within a request
+# instead of reopened for each one; closed on app context teardown
+_local = threading.local()
+
 def get_db_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # This enables column access by name
+    """Get the current thread's database connection, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != DATABASE:
+        close_db_connection()
+        conn = sqlite3.connect(DATABASE)
+        conn.row_factory = sqlite3.Row  # This enables column access by name
+        # synchronous is per connection; journal_mode=WAL persists and is set in init_database
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
+        _local.path = DATABASE
     return conn
 
+def close_db_connection(exception=None):
+    """Close the current thread's database connection, if one is open."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+atexit.register(close_db_connection)
+
+def to_timestamp(dt: datetime) -> int:
+    """Convert a stored (naive) datetime to whole seconds, matching SQLite's strftime('%s')."""
+    return calendar.timegm(dt.timetuple())
+
 def init_database():
     """Initialize the database with required tables."""
     conn = get_db_connection()
     
+    # WAL mode is stored in the database file, so it only needs setting once
+    conn.execute('PRAGMA journal_mode=WAL')
+    
     # Create books table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS books (
@@ -41,12 +73,37 @@ def init_database():
             borrow_date TEXT NOT NULL,
             due_date TEXT NOT NULL,
             return_date TEXT,
+            due_ts INTEGER,
+            return_ts INTEGER,
             FOREIGN KEY (book_id) REFERENCES books (id)
         )
     ''')
     
+    # Migrate older databases: integer copies of the dates so fee lookups skip date parsing
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(borrow_records)')}
+    for column in ('due_ts', 'return_ts'):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE borrow_records ADD COLUMN {column} INTEGER')
+    conn.execute('''
+        UPDATE borrow_records
+        SET due_ts = CAST(strftime('%s', due_date) AS INTEGER),
+            return_ts = CAST(strftime('%s', return_date) AS INTEGER)
+        WHERE due_ts IS NULL OR (return_date IS NOT NULL AND return_ts IS NULL)
+    ''')
+    
+    # Index for latest-record lookups (ORDER BY borrow_date DESC LIMIT 1)
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_br_patron_book_date
+        ON borrow_records (patron_id, book_id, borrow_date DESC)
+    ''')
+    
+    # Partial index over active loans for borrow counts and borrowed-book lists
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_br_patron_active
+        ON borrow_records (patron_id) WHERE return_date IS NULL
+    ''')
+    
     conn.commit()
-    conn.close()
 
 def add_sample_data():
     """Add sample data to the database if it's empty."""
@@ -68,19 +125,20 @@ def add_sample_data():
             ''', (title, author, isbn, copies, copies))
         
         # Make 1984 unavailable by adding a borrow record
+        due_date = datetime.now() + timedelta(days=9)
         conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
+            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, due_ts)
+            VALUES (?, ?, ?, ?, ?)
         ''', ('123456', 3, 
               (datetime.now() - timedelta(days=5)).isoformat(),
-              (datetime.now() + timedelta(days=9)).isoformat()))
+              due_date.isoformat(), to_timestamp(due_date)))
         
         # Update available copies for 1984
         conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
         
         conn.commit()
-    
-    conn.close()
+        clear_book_cache()
+        invalidate_patron_loans()
 
 # Helper Functions for Database Operations
 
@@ -88,114 +146,268 @@ def get_all_books() -> List[Dict]:
     """Get all books from the database."""
     conn = get_db_connection()
     books = conn.execute('SELECT * FROM books ORDER BY title').fetchall()
-    conn.close()
     return [dict(book) for book in books]
 
+# Only the static book columns are cached, as immutable (column, value) tuples keyed
+# by database path and id. available_copies (and whether the book exists at all) is
+# always read fresh, so writes from other processes are never hidden by the cache.
+@lru_cache(maxsize=2048)
+def _get_book_static_cached(database: str, book_id: int) -> Optional[tuple]:
+    conn = get_db_connection()
+    book = conn.execute(
+        'SELECT id, title, author, isbn, total_copies FROM books WHERE id = ?', (book_id,)
+    ).fetchone()
+    return tuple(dict(book).items()) if book else None
+
+def clear_book_cache():
+    """Drop cached static book columns."""
+    _get_book_static_cached.cache_clear()
+
 def get_book_by_id(book_id: int) -> Optional[Dict]:
     """Get a specific book by ID."""
     conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
-    return dict(book) if book else None
+    row = conn.execute('SELECT available_copies FROM books WHERE id = ?', (book_id,)).fetchone()
+    if not row:
+        return None
+    static = _get_book_static_cached(DATABASE, book_id)
+    if not static:
+        return None
+    book = dict(static)
+    book['available_copies'] = row['available_copies']
+    return book
 
-def get_book_by_isbn(isbn: str) -> Optional[Dict]:
-    """Get a specific book by ISBN."""
+_BOOK_COLUMNS = 'id, title, author, isbn, total_copies, available_copies'
+
+def search_books(search_term: str, field: str, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+    """Search books by partial title/author match or exact ISBN, optionally one page at a time."""
     conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE isbn = ?', (isbn,)).fetchone()
-    conn.close()
-    return dict(book) if book else None
+    page = (-1 if limit is None else limit, offset)  # LIMIT -1 means no limit in SQLite
+    if field == 'isbn':
+        books = conn.execute(f'SELECT {_BOOK_COLUMNS} FROM books WHERE isbn = ? LIMIT ? OFFSET ?',
+                             (search_term, *page))
+    elif field in ('title', 'author'):
+        # LIKE is case-insensitive for ASCII; escape wildcards in the search term
+        pattern = '%' + search_term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        books = conn.execute(
+            f"SELECT {_BOOK_COLUMNS} FROM books WHERE {field} LIKE ? ESCAPE '\\' ORDER BY title LIMIT ? OFFSET ?",
+            (pattern, *page)
+        )
+    else:
+        return []
+    return [dict(book) for book in books]
+
+# Short-lived cache of each patron's active loans, keyed by (database, patron_id).
+# Writes from this process invalidate it; writes from other processes are only
+# picked up once an entry expires, which is acceptable for these read paths.
+PATRON_LOAN_CACHE_TTL = 60  # seconds
+PATRON_LOAN_CACHE_SIZE = 10000
+_patron_loan_cache: Dict[Tuple[str, str], Tuple[float, List[tuple]]] = {}
+_patron_loan_cache_lock = threading.Lock()  # guards mutation under the threaded server
+# Bumped on every invalidation so a read that overlapped a write doesn't store stale loans.
+# _patron_loan_epoch covers invalidating everyone, which also resets the per-key counters.
+_patron_loan_generation: Dict[Tuple[str, str], int] = {}
+_patron_loan_epoch = 0
+
+def _patron_loan_version(key: Tuple[str, str]) -> Tuple[int, int]:
+    return _patron_loan_epoch, _patron_loan_generation.get(key, 0)
+
+def invalidate_patron_loans(patron_id: Optional[str] = None):
+    """Drop cached active loans for one patron, or for everyone if no ID is given."""
+    global _patron_loan_epoch
+    with _patron_loan_cache_lock:
+        if patron_id is None:
+            _patron_loan_cache.clear()
+            _patron_loan_generation.clear()
+            _patron_loan_epoch += 1
+        else:
+            key = (DATABASE, patron_id)
+            _patron_loan_cache.pop(key, None)
+            _patron_loan_generation[key] = _patron_loan_generation.get(key, 0) + 1
 
-def get_patron_borrowed_books(patron_id: str) -> List[Dict]:
-    """Get currently borrowed books for a patron."""
+def _get_patron_loans(patron_id: str) -> List[tuple]:
+    """Get (book_id, title, author, borrow_date, due_date, due_ts) for a patron's active loans."""
+    key = (DATABASE, patron_id)
+    cached = _patron_loan_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
+    with _patron_loan_cache_lock:
+        version = _patron_loan_version(key)
     conn = get_db_connection()
     records = conn.execute('''
-        SELECT br.*, b.title, b.author 
+        SELECT br.book_id, b.title, b.author, br.borrow_date, br.due_date,
+               COALESCE(br.due_ts, CAST(strftime('%s', br.due_date) AS INTEGER))
         FROM borrow_records br 
         JOIN books b ON br.book_id = b.id 
         WHERE br.patron_id = ? AND br.return_date IS NULL
         ORDER BY br.borrow_date
     ''', (patron_id,)).fetchall()
-    conn.close()
-    
-    borrowed_books = []
-    for record in records:
-        borrowed_books.append({
-            'book_id': record['book_id'],
-            'title': record['title'],
-            'author': record['author'],
-            'borrow_date': datetime.fromisoformat(record['borrow_date']),
-            'due_date': datetime.fromisoformat(record['due_date']),
-            'is_overdue': datetime.now() > datetime.fromisoformat(record['due_date'])
-        })
+    loans = [(book_id, title, author, datetime.fromisoformat(borrow_date), datetime.fromisoformat(due_date), due_ts)
+             for book_id, title, author, borrow_date, due_date, due_ts in records]
     
-    return borrowed_books
+    with _patron_loan_cache_lock:
+        if _patron_loan_version(key) != version:
+            return loans  # invalidated while reading; don't cache a possibly stale result
+        # Refreshing an existing key doesn't grow the cache, so only evict for new keys
+        if key not in _patron_loan_cache and len(_patron_loan_cache) >= PATRON_LOAN_CACHE_SIZE:
+            del _patron_loan_cache[next(iter(_patron_loan_cache))]  # evict oldest entry
+        _patron_loan_cache[key] = (time.monotonic() + PATRON_LOAN_CACHE_TTL, loans)
+    return loans
+
+def get_patron_borrowed_books(patron_id: str, now: Optional[datetime] = None) -> List[Dict]:
+    """Get currently borrowed books for a patron, flagging those overdue as of `now`."""
+    now = now or datetime.now()
+    return [{
+        'book_id': book_id,
+        'title': title,
+        'author': author,
+        'borrow_date': borrow_date,
+        'due_date': due_date,
+        'due_ts': due_ts,
+        'is_overdue': now > due_date
+    } for book_id, title, author, borrow_date, due_date, due_ts in _get_patron_loans(patron_id)]
+
+def get_patron_borrow_history(patron_id: str) -> List[Dict]:
+    """Get a patron's returned borrow records, oldest first."""
+    conn = get_db_connection()
+    records = conn.execute('''
+        SELECT br.book_id, b.title, b.author, br.borrow_date, br.due_date, br.return_date
+        FROM borrow_records br
+        JOIN books b ON br.book_id = b.id
+        WHERE br.patron_id = ? AND br.return_date IS NOT NULL
+        ORDER BY br.borrow_date
+    ''', (patron_id,)).fetchall()
+    return [{
+        'book_id': book_id,
+        'title': title,
+        'author': author,
+        'borrow_date': datetime.fromisoformat(borrow_date),
+        'due_date': datetime.fromisoformat(due_date),
+        'return_date': datetime.fromisoformat(return_date)
+    } for book_id, title, author, borrow_date, due_date, return_date in records]
+
+def get_latest_borrow_timestamps(patron_id: str, book_id: int) -> Optional[Tuple[int, Optional[int]]]:
+    """Get (due_ts, return_ts) of the most recent borrow record for a patron and book."""
+    conn = get_db_connection()
+    # Fall back to the text dates for rows written without the integer columns
+    record = conn.execute('''
+        SELECT COALESCE(due_ts, CAST(strftime('%s', due_date) AS INTEGER)),
+               COALESCE(return_ts, CAST(strftime('%s', return_date) AS INTEGER))
+        FROM borrow_records
+        WHERE patron_id = ? AND book_id = ?
+        ORDER BY borrow_date DESC LIMIT 1
+    ''', (patron_id, book_id)).fetchone()
+    return tuple(record) if record else None
+
+def get_active_borrow(patron_id: str, book_id: int) -> Optional[Dict]:
+    """Get a patron's oldest active (unreturned) borrow of a specific book, if any."""
+    conn = get_db_connection()
+    record = conn.execute('''
+        SELECT br.id, br.book_id, br.due_date, b.title,
+               COALESCE(br.due_ts, CAST(strftime('%s', br.due_date) AS INTEGER))
+        FROM borrow_records br
+        JOIN books b ON br.book_id = b.id
+        WHERE br.patron_id = ? AND br.book_id = ? AND br.return_date IS NULL
+        ORDER BY br.borrow_date
+        LIMIT 1
+    ''', (patron_id, book_id)).fetchone()
+    if not record:
+        return None
+    record_id, book_id, due_date, title, due_ts = record
+    return {'id': record_id, 'book_id': book_id, 'title': title,
+            'due_date': datetime.fromisoformat(due_date), 'due_ts': due_ts}
 
 def get_patron_borrow_count(patron_id: str) -> int:
     """Get the number of books currently borrowed by a patron."""
+    return len(_get_patron_loans(patron_id))
+
+def get_outstanding_due_timestamps() -> List[Tuple[str, int]]:
+    """Get (patron_id, due_ts) for every unreturned loan, ordered by patron."""
     conn = get_db_connection()
-    count = conn.execute('''
-        SELECT COUNT(*) as count FROM borrow_records 
-        WHERE patron_id = ? AND return_date IS NULL
-    ''', (patron_id,)).fetchone()['count']
-    conn.close()
-    return count
-
-def insert_book(title: str, author: str, isbn: str, total_copies: int, available_copies: int) -> bool:
-    """Insert a new book into the database."""
+    records = conn.execute('''
+        SELECT patron_id, COALESCE(due_ts, CAST(strftime('%s', due_date) AS INTEGER))
+        FROM borrow_records
+        WHERE return_date IS NULL
+        ORDER BY patron_id
+    ''').fetchall()
+    return [tuple(record) for record in records]
+
+def insert_book(title: str, author: str, isbn: str, total_copies: int, available_copies: int) -> Tuple[bool, bool]:
+    """
+    Insert a new book into the database.
+    Relies on the UNIQUE isbn constraint instead of a separate lookup for duplicates.
+    
+    Returns:
+        tuple: (inserted: bool, duplicate: bool)
+    """
     conn = get_db_connection()
     try:
-        conn.execute('''
+        # Only an ISBN clash is ignored; other constraint failures still raise
+        cursor = conn.execute('''
             INSERT INTO books (title, author, isbn, total_copies, available_copies)
             VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(isbn) DO NOTHING
         ''', (title, author, isbn, total_copies, available_copies))
         conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        return False
-
-def insert_borrow_record(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime) -> bool:
-    """Insert a new borrow record into the database."""
-    conn = get_db_connection()
-    try:
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
-        ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat()))
-        conn.commit()
-        conn.close()
-        return True
+        if cursor.rowcount == 0:
+            return False, True
+        clear_book_cache()
+        return True, False
     except Exception as e:
-        conn.close()
-        return False
+        conn.rollback()
+        return False, False
 
-def update_book_availability(book_id: int, change: int) -> bool:
-    """Update the available copies of a book by a given amount (+1 for return, -1 for borrow)."""
+def borrow_transaction(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime) -> Tuple[bool, bool]:
+    """
+    Decrement availability and insert a borrow record in one transaction.
+    Changes nothing if no copy is available when the transaction runs.
+    
+    Returns:
+        tuple: (borrowed: bool, unavailable: bool)
+    """
     conn = get_db_connection()
     try:
+        conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.execute('''
+            UPDATE books SET available_copies = available_copies - 1
+            WHERE id = ? AND available_copies > 0
+        ''', (book_id,))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return False, True
         conn.execute('''
-            UPDATE books SET available_copies = available_copies + ? WHERE id = ?
-        ''', (change, book_id))
+            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, due_ts)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat(), to_timestamp(due_date)))
         conn.commit()
-        conn.close()
-        return True
+        invalidate_patron_loans(patron_id)
+        return True, False
     except Exception as e:
-        conn.close()
-        return False
+        conn.rollback()
+        return False, False
 
-def update_borrow_record_return_date(patron_id: str, book_id: int, return_date: datetime) -> bool:
-    """Update the return date for a borrow record."""
+def return_transaction(record_id: int, patron_id: str, book_id: int, return_date: datetime) -> bool:
+    """
+    Close one borrow record and increment availability in one transaction.
+    Fails (and changes nothing) if the record is not an active loan of this book.
+    """
     conn = get_db_connection()
     try:
-        conn.execute('''
+        conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.execute('''
             UPDATE borrow_records 
-            SET return_date = ? 
-            WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
-        ''', (return_date.isoformat(), patron_id, book_id))
+            SET return_date = ?, return_ts = ?
+            WHERE id = ? AND patron_id = ? AND book_id = ? AND return_date IS NULL
+        ''', (return_date.isoformat(), to_timestamp(return_date), record_id, patron_id, book_id))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return False
+        conn.execute('''
+            UPDATE books SET available_copies = available_copies + 1 WHERE id = ?
+        ''', (book_id,))
         conn.commit()
-        conn.close()
+        invalidate_patron_loans(patron_id)
         return True
     except Exception as e:
-        conn.close()
+        conn.rollback()
         return False
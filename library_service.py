@@ -3,15 +3,30 @@ Library Service Module - Business Logic Functions
 Contains all the core business logic for the Library Management System
 """
 
+import re
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 from database import (
-    get_book_by_id, get_book_by_isbn, get_patron_borrow_count,
-    insert_book, insert_borrow_record, update_book_availability,
-    update_borrow_record_return_date, get_all_books
+    get_book_by_id, get_patron_borrow_count,
+    insert_book, borrow_transaction, return_transaction, get_all_books,
+    get_patron_borrowed_books, get_patron_borrow_history, get_active_borrow,
+    get_latest_borrow_timestamps, search_books, get_outstanding_due_timestamps, to_timestamp
 )
 from services.payment_service import PaymentGateway
 
+try:
+    from numba import njit, float64, int64
+except ImportError:  # numba is optional; fall back to plain Python
+    njit = None
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; bulk fee reports fall back to a loop
+    np = None
+
+# ASCII-only pattern; str.isdigit() would also accept other Unicode digits
+_PATRON_RE = re.compile(r"\A[0-9]{6}\Z")
+
 def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -> Tuple[bool, str]:
     """
     Add a new book to the catalog.
@@ -26,34 +41,34 @@ def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -
     Returns:
         tuple: (success: bool, message: str)
     """
-    # Input validation
-    if not title or not title.strip():
+    # Input validation (strip each field once and reuse it)
+    title = title.strip() if title else ''
+    if not title:
         return False, "Title is required."
     
-    if len(title.strip()) > 200:
+    if len(title) > 200:
         return False, "Title must be less than 200 characters."
     
-    if not author or not author.strip():
+    author = author.strip() if author else ''
+    if not author:
         return False, "Author is required."
     
-    if len(author.strip()) > 100:
+    if len(author) > 100:
         return False, "Author must be less than 100 characters."
     
-    if len(isbn) != 13:
+    # Cheapest check first; isascii() rules out non-ASCII digits that isdigit() accepts
+    if not isbn or len(isbn) != 13 or not isbn.isascii() or not isbn.isdigit():
         return False, "ISBN must be exactly 13 digits."
     
     if not isinstance(total_copies, int) or total_copies <= 0:
         return False, "Total copies must be a positive integer."
     
-    # Check for duplicate ISBN
-    existing = get_book_by_isbn(isbn)
-    if existing:
-        return False, "A book with this ISBN already exists."
-    
-    # Insert new book
-    success = insert_book(title.strip(), author.strip(), isbn, total_copies, total_copies)
+    # Insert new book; a duplicate ISBN is reported by the insert itself
+    success, duplicate = insert_book(title, author, isbn, total_copies, total_copies)
     if success:
-        return True, f'Book "{title.strip()}" has been successfully added to the catalog.'
+        return True, f'Book "{title}" has been successfully added to the catalog.'
+    elif duplicate:
+        return False, "A book with this ISBN already exists."
     else:
         return False, "Database error occurred while adding the book."
 
@@ -70,7 +85,7 @@ def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
         tuple: (success: bool, message: str)
     """
     # Validate patron ID
-    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+    if not patron_id or not _PATRON_RE.match(patron_id):
         return False, "Invalid patron ID. Must be exactly 6 digits."
     
     # Check if book exists and is available
@@ -91,56 +106,184 @@ def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     borrow_date = datetime.now()
     due_date = borrow_date + timedelta(days=14)
     
-    # Insert borrow record and update availability
-    borrow_success = insert_borrow_record(patron_id, book_id, borrow_date, due_date)
+    # Insert borrow record and update availability atomically
+    borrow_success, unavailable = borrow_transaction(patron_id, book_id, borrow_date, due_date)
+    if unavailable:
+        # Another borrower took the last copy after the check above
+        return False, "This book is currently not available."
     if not borrow_success:
         return False, "Database error occurred while creating borrow record."
     
-    availability_success = update_book_availability(book_id, -1)
-    if not availability_success:
-        return False, "Database error occurred while updating book availability."
-    
-    return True, f'Successfully borrowed "{book["title"]}". Due date: {due_date.strftime("%Y-%m-%d")}.'
+    return True, f'Successfully borrowed "{book["title"]}". Due date: {due_date.date().isoformat()}.'
 
 def return_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     """
     Process book return by a patron.
+    Implements R4: Book Return Processing
+    
+    Args:
+        patron_id: 6-digit library card ID
+        book_id: ID of the book to return
+        
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    # Validate patron ID
+    if not patron_id or not _PATRON_RE.match(patron_id):
+        return False, "Invalid patron ID. Must be exactly 6 digits."
     
-    TODO: Implement R4 as per requirements
+    # Verify the book is currently borrowed by this patron
+    borrowed = get_active_borrow(patron_id, book_id)
+    if not borrowed:
+        return False, "No active borrow record found for this patron and book."
+    
+    # Record return date and update availability atomically
+    return_date = datetime.now()
+    return_success = return_transaction(borrowed['id'], patron_id, book_id, return_date)
+    if not return_success:
+        return False, "Database error occurred while processing the return."
+    
+    fee_amount = _compute_fee(_days_overdue(borrowed["due_ts"], to_timestamp(return_date)))
+    if fee_amount > 0:
+        return True, f'Successfully returned "{borrowed["title"]}". Late fee owed: ${fee_amount:.2f}.'
+    return True, f'Successfully returned "{borrowed["title"]}". No late fees owed.'
+
+def _days_overdue(due_ts: int, returned_ts: int) -> int:
+    """
+    Number of whole days a book was (or still is) kept past its due date.
+    Every fee is counted from integer timestamps through here, so they always agree.
+    """
+    return max((returned_ts - due_ts) // 86400, 0)
+
+def _compute_fee(days_overdue: int) -> float:
+    """
+    Compute the late fee for a number of days overdue.
+    $0.50/day for the first 7 days, $1.00/day after that, capped at $15.00.
     """
-    return False, "Book return functionality is not yet implemented."
+    days = max(days_overdue, 0)
+    # Branchless form of the two tiers; matches the vectorized report below
+    return round(min(0.50 * min(days, 7) + 1.00 * max(days - 7, 0), 15.00), 2)
 
-def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
+if njit is not None:
+    _compute_fee = njit(float64(int64), cache=True)(_compute_fee)
+    _compute_fee(0)  # warm up so the first request doesn't pay compile latency
+
+def calculate_late_fee_for_book(patron_id: str, book_id: int, now: Optional[datetime] = None) -> Dict:
     """
     Calculate late fees for a specific book.
+    Implements R5: Late Fee Calculation
     
-    TODO: Implement R5 as per requirements 
-    
-    
-    return { // return the calculated values
-        'fee_amount': 0.00,
-        'days_overdue': 0,
-        'status': 'Late fee calculation not implemented'
-    }
+    Args:
+        patron_id: 6-digit library card ID
+        book_id: ID of the borrowed book
+        now: Time to measure unreturned books against (defaults to the current time)
+        
+    Returns:
+        dict: fee_amount, days_overdue and status
     """
+    record = get_latest_borrow_timestamps(patron_id, book_id)
+    if not record:
+        return {'fee_amount': 0.00, 'days_overdue': 0, 'status': 'No record found for this patron and book.'}
+    
+    # Integer seconds straight from the database; no date parsing needed
+    due_ts, return_ts = record
+    returned_ts = return_ts if return_ts is not None else to_timestamp(now or datetime.now())
+    days_overdue = _days_overdue(due_ts, returned_ts)
+    fee_amount = _compute_fee(days_overdue)
+    
+    status = 'Overdue' if days_overdue > 0 else 'No late fee'
+    return {'fee_amount': fee_amount, 'days_overdue': days_overdue, 'status': status}
 
-def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
+def search_books_in_catalog(search_term: str, search_type: str,
+                            limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
     """
     Search for books in the catalog.
+    Implements R6: Book Search Functionality
     
-    TODO: Implement R6 as per requirements
+    Args:
+        search_term: Text to search for
+        search_type: 'title' or 'author' (partial, case-insensitive) or 'isbn' (exact)
+        limit: Maximum number of results to return (all results if None)
+        offset: Number of results to skip, for paging
+        
+    Returns:
+        list: Matching books in the same format as the catalog
     """
+    if not search_term or not search_term.strip():
+        return []
     
-    return []
+    # Filtering happens in SQLite rather than over every row in Python
+    return search_books(search_term.strip(), search_type, limit, offset)
 
 def get_patron_status_report(patron_id: str) -> Dict:
     """
     Get status report for a patron.
+    Implements R7: Patron Status Report
     
-    TODO: Implement R7 as per requirements
+    Args:
+        patron_id: 6-digit library card ID
+        
+    Returns:
+        dict: borrowed books with due dates, borrow count, total late fees and
+        borrowing history (returned books), or an 'error' entry if the patron ID is invalid
     """
-    return {}
+    if not patron_id or not _PATRON_RE.match(patron_id):
+        return {'error': "Invalid patron ID. Must be exactly 6 digits."}
+    
+    # Due timestamps come back with the borrowed books, so fees need no
+    # further queries; one 'now' keeps them consistent across the report
+    now = datetime.now()
+    now_ts = to_timestamp(now)
+    borrowed_books = get_patron_borrowed_books(patron_id, now)
+    
+    total_late_fees = 0.0
+    for book in borrowed_books:
+        fee_amount = _compute_fee(_days_overdue(book['due_ts'], now_ts))
+        book['late_fee'] = fee_amount
+        total_late_fees += fee_amount
+    
+    return {
+        'patron_id': patron_id,
+        'borrowed_books': borrowed_books,
+        'borrowed_count': len(borrowed_books),
+        'total_late_fees': round(total_late_fees, 2),
+        'borrowing_history': get_patron_borrow_history(patron_id)
+    }
 
+def get_outstanding_late_fees_by_patron(now: Optional[datetime] = None) -> Dict[str, float]:
+    """
+    Get total late fees currently accrued on unreturned books, per patron.
+    Intended for admin overdue reports covering every patron at once.
+    
+    Args:
+        now: Time to measure loans against (defaults to the current time)
+        
+    Returns:
+        dict: patron_id -> total late fee owed (only patrons with active loans)
+    """
+    loans = get_outstanding_due_timestamps()
+    if not loans:
+        return {}
+    now_ts = to_timestamp(now or datetime.now())
+    
+    if np is None:
+        totals: Dict[str, float] = {}
+        for patron_id, due_ts in loans:
+            fee = _compute_fee(_days_overdue(due_ts, now_ts))
+            totals[patron_id] = round(totals.get(patron_id, 0.0) + fee, 2)
+        return totals
+    
+    # Vectorized path: one pass over all loans instead of one call per loan
+    patron_ids = np.array([patron_id for patron_id, _ in loans])
+    # Same integer arithmetic as _days_overdue, applied to the whole column
+    due = np.array([due_ts for _, due_ts in loans], dtype=np.int64)
+    days = np.maximum((now_ts - due) // 86400, 0)
+    fees = np.minimum(0.50 * np.minimum(days, 7) + 1.00 * np.maximum(days - 7, 0), 15.00).round(2)
+    
+    # Loans are ordered by patron, so each patron's fees are one contiguous run
+    patrons, starts = np.unique(patron_ids, return_index=True)
+    totals = np.add.reduceat(fees, starts)
+    return {str(p): round(float(t), 2) for p, t in zip(patrons, totals)}
 
 def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway = None) -> Tuple[bool, str, Optional[str]]:
     """
@@ -164,7 +307,7 @@ def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway
         success, msg, txn = pay_late_fees("123456", 1, mock_gateway)
     """
     # Validate patron ID
-    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+    if not patron_id or not _PATRON_RE.match(patron_id):
         return False, "Invalid patron ID. Must be exactly 6 digits.", None
     
     # Calculate late fee first
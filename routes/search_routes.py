@@ -23,6 +23,6 @@ def search_books():
     books = search_books_in_catalog(search_term, search_type)
     
     if not books:
-        flash('Search functionality is not yet implemented.', 'error')
+        flash(f'No books found matching "{search_term}".', 'error')
     
     return render_template('search.html', books=books, search_term=search_term, search_type=search_type)
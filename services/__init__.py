@@ -2,6 +2,14 @@
 Services package initializer.
 For Assignment 3 testing only — avoids importing Flask blueprints.
 """
-# Keep empty or just expose submodules safely.
-from . import library_service
-from . import payment_service
+import importlib
+
+
+def __getattr__(name):
+    """Import submodules lazily on first access (PEP 562)."""
+    try:
+        return importlib.import_module(f"{__name__}.{name}")
+    except ModuleNotFoundError as e:
+        if e.name != f"{__name__}.{name}":
+            raise
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
@@ -0,0 +1,8 @@
+# tests/conftest.py
+import os
+import sys
+
+# Ensure imports work when pytest runs from repo root (done once, not per test module)
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -1,16 +1,7 @@
 # tests/test_payment_mock_stub.py
-import os
-import sys
 import pytest
 from unittest.mock import Mock
 
-# ---------------------------------------------------------------------
-# Ensure imports work when pytest runs from project root
-# ---------------------------------------------------------------------
-ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-if ROOT not in sys.path:
-    sys.path.insert(0, ROOT)
-
 from services.library_service import pay_late_fees, refund_late_fee_payment
 
 
@@ -1,21 +1,30 @@
 # tests/test_unit.py
-import os
-import sys
+import sqlite3
 import pytest
+from datetime import datetime, timedelta
 
-# Ensure imports work when pytest runs from repo root
-ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-if ROOT not in sys.path:
-    sys.path.insert(0, ROOT)
-
+import database
 from services.library_service import (
     add_book_to_catalog,
+    borrow_book_by_patron,
     return_book_by_patron,
     calculate_late_fee_for_book,
     search_books_in_catalog,
     get_patron_status_report,
+    _compute_fee,
+    _days_overdue,
+    get_outstanding_late_fees_by_patron,
 )
 
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """Point the database module at a fresh sample database for one test."""
+    monkeypatch.setattr(database, "DATABASE", str(tmp_path / "library.db"))
+    database.init_database()
+    database.add_sample_data()
+    yield
+    database.close_db_connection()
+
 def test_add_book_invalid_isbn_too_short():
     success, message = add_book_to_catalog("Test Book", "Test Author", "123456789", 3)
     assert success is False
@@ -26,6 +35,11 @@ def test_add_book_invalid_isbn_too_long():
     assert success is False
     assert "13 digits" in message.lower()
 
+def test_add_book_invalid_isbn_non_digits():
+    success, message = add_book_to_catalog("Test Book", "Test Author", "12345678901ab", 3)
+    assert success is False
+    assert "13 digits" in message.lower()
+
 def test_add_book_negative_copies():
     success, message = add_book_to_catalog("Test Book", "Test Author", "1234567890123", -1)
     assert success is False
@@ -55,22 +69,265 @@ def test_add_book_long_author():
     success, message = add_book_to_catalog("Test Book", long_author, "1234567890123", 3)
     assert success is False
     assert "author" in message.lower()
-'''
-def test_return_book_not_borrowed():
+
+def test_add_book_duplicate_isbn(temp_db):
+    success, message = add_book_to_catalog("Copy", "Someone", "9780451524935", 1)
+    assert success is False
+    assert "already exists" in message.lower()
+
+def test_insert_book_constraint_failure_is_not_duplicate(temp_db):
+    assert database.insert_book("Untitled", None, "1234567890123", 1, 1) == (False, False)
+
+def test_compute_fee_tiers():
+    assert _compute_fee(0) == 0.0
+    assert _compute_fee(3) == 1.5
+    assert _compute_fee(10) == 6.5
+    assert _compute_fee(40) == 15.0
+
+def test_compute_fee_compiled_matches_python():
+    pytest.importorskip("numba")
+    # With numba installed _compute_fee is the compiled dispatcher; py_func is the source
+    assert hasattr(_compute_fee, "py_func")
+    for days in range(-3, 40):
+        assert _compute_fee(days) == _compute_fee.py_func(days)
+
+def test_days_overdue_not_negative():
+    due = database.to_timestamp(datetime(2025, 1, 1))
+    assert _days_overdue(due, due - 2 * 86400) == 0
+    assert _days_overdue(due, due + 10 * 86400) == 10
+    assert _days_overdue(due, due + 8 * 86400 - 1) == 7  # partial days don't count
+
+def _mock_outstanding_loans(mocker):
+    """Patch in one day-boundary case per row; returns (now, expected totals)."""
+    now = datetime(2025, 6, 1, 12, 0, 0)
+    now_ts = database.to_timestamp(now)
+    # Rows arrive ordered by patron, as get_outstanding_due_timestamps returns them
+    mocker.patch(
+        "services.library_service.get_outstanding_due_timestamps",
+        return_value=[
+            ("111111", now_ts + int(2.5 * 86400)),   # not yet due
+            ("111111", now_ts - int(0.4 * 86400)),   # 0 days
+            ("111111", now_ts - int(7.9 * 86400)),   # 7 days -> 3.50
+            ("222222", now_ts - 8 * 86400),          # 8 days -> 4.50
+            ("222222", now_ts - int(30.2 * 86400)),  # 30 days -> capped at 15.00
+            ("333333", now_ts - 7 * 86400),          # 7 days -> 3.50
+        ],
+    )
+    return now, {"111111": 3.5, "222222": 19.5, "333333": 3.5}
+
+def test_outstanding_late_fees_grouped_by_patron(mocker):
+    now, expected = _mock_outstanding_loans(mocker)
+    mocker.patch("services.library_service.np", None)  # pure-Python fallback
+    assert get_outstanding_late_fees_by_patron(now) == expected
+
+def test_outstanding_late_fees_vectorized_matches_fallback(mocker):
+    np = pytest.importorskip("numpy")
+    now, expected = _mock_outstanding_loans(mocker)
+    mocker.patch("services.library_service.np", np)
+    assert get_outstanding_late_fees_by_patron(now) == expected
+
+def test_outstanding_late_fees_no_loans(mocker):
+    mocker.patch("services.library_service.get_outstanding_due_timestamps", return_value=[])
+    assert get_outstanding_late_fees_by_patron() == {}
+
+def test_return_book_not_borrowed(temp_db):
     success, msg = return_book_by_patron("999999", 2)
     assert success is False
     assert "no active borrow" in msg.lower()
 
-def test_calculate_fee_no_record():
+def test_calculate_fee_no_record(temp_db):
     fee = calculate_late_fee_for_book("000000", 1)
     assert fee["fee_amount"] == 0.0
     assert "no record" in fee["status"].lower()
 
-def test_search_books_by_title():
+def test_search_books_by_title(temp_db):
     results = search_books_in_catalog("1984", "title")
     assert any("1984" in b.get("title", "") for b in results)
 
+def test_search_books_paging(temp_db):
+    titles = lambda books: [b["title"] for b in books]
+    assert titles(search_books_in_catalog("a", "title")) == ["The Great Gatsby", "To Kill a Mockingbird"]
+    assert titles(search_books_in_catalog("a", "title", limit=1)) == ["The Great Gatsby"]
+    assert titles(search_books_in_catalog("a", "title", limit=1, offset=1)) == ["To Kill a Mockingbird"]
+    assert titles(search_books_in_catalog("a", "title", limit=None, offset=1)) == ["To Kill a Mockingbird"]
+    assert search_books_in_catalog("a", "title", limit=1, offset=2) == []
+
 def test_patron_status_invalid_id():
     report = get_patron_status_report("abc123")
     assert "error" in str(report).lower()
-'''
+
+def test_patron_status_report_lists_borrowed_books(temp_db):
+    report = get_patron_status_report("123456")
+    assert report["borrowed_count"] == 1
+    assert report["borrowed_books"][0]["title"] == "1984"
+    assert report["total_late_fees"] == 0.0
+    assert report["borrowing_history"] == []
+
+def test_patron_status_report_includes_returned_books(temp_db):
+    assert borrow_book_by_patron("555555", 1)[0] is True
+    assert return_book_by_patron("555555", 1)[0] is True
+    report = get_patron_status_report("555555")
+    assert report["borrowed_count"] == 0
+    assert [b["title"] for b in report["borrowing_history"]] == ["The Great Gatsby"]
+    assert report["borrowing_history"][0]["return_date"] is not None
+
+def test_borrow_then_return_restores_availability(temp_db):
+    success, _ = borrow_book_by_patron("555555", 1)
+    assert success is True
+    assert database.get_book_by_id(1)["available_copies"] == 2
+
+    success, msg = return_book_by_patron("555555", 1)
+    assert success is True
+    assert "no late fees" in msg.lower()
+    assert database.get_book_by_id(1)["available_copies"] == 3
+
+    # A second return has nothing to close and must not add a copy
+    success, _ = return_book_by_patron("555555", 1)
+    assert success is False
+    assert database.get_book_by_id(1)["available_copies"] == 3
+
+def test_return_closes_only_one_of_duplicate_loans(temp_db):
+    assert borrow_book_by_patron("555555", 2)[0] is True
+    assert borrow_book_by_patron("555555", 2)[0] is True
+    assert database.get_book_by_id(2)["available_copies"] == 0
+
+    assert return_book_by_patron("555555", 2)[0] is True
+    assert database.get_book_by_id(2)["available_copies"] == 1
+    assert database.get_patron_borrow_count("555555") == 1
+
+def test_borrow_invalidates_cached_loan_count(temp_db):
+    assert database.get_patron_borrow_count("555555") == 0  # warms the loan cache
+    assert borrow_book_by_patron("555555", 1)[0] is True
+    assert database.get_patron_borrow_count("555555") == 1
+    assert return_book_by_patron("555555", 1)[0] is True
+    assert database.get_patron_borrow_count("555555") == 0
+
+def test_loan_cache_skips_store_when_invalidated_during_read(temp_db, monkeypatch):
+    real_get_conn = database.get_db_connection
+
+    class BorrowAfterSelect:
+        """Connection proxy that lands a borrow between the loan query and the cache store."""
+        def __init__(self, conn):
+            self.conn = conn
+        def execute(self, *args):
+            rows = self.conn.execute(*args).fetchall()
+            monkeypatch.setattr(database, "get_db_connection", real_get_conn)
+            due = datetime.now() + timedelta(days=14)
+            assert database.borrow_transaction("555555", 1, datetime.now(), due) == (True, False)
+            return type("Result", (), {"fetchall": lambda _self: rows})()
+
+    monkeypatch.setattr(database, "get_db_connection", lambda: BorrowAfterSelect(real_get_conn()))
+    assert database.get_patron_borrow_count("555555") == 0  # read started before the borrow
+    assert database.get_patron_borrow_count("555555") == 1  # stale result was not cached
+
+def test_loan_cache_entry_expires_after_ttl(temp_db, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(database.time, "monotonic", lambda: clock[0])
+    assert database.get_patron_borrow_count("555555") == 0  # warms the loan cache
+
+    # A write from another process doesn't invalidate this process's cache
+    conn = sqlite3.connect(database.DATABASE)
+    now = datetime.now()
+    conn.execute(
+        "INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date) VALUES (?, ?, ?, ?)",
+        ("555555", 1, now.isoformat(), (now + timedelta(days=14)).isoformat()),
+    )
+    conn.commit()
+    conn.close()
+
+    clock[0] += database.PATRON_LOAN_CACHE_TTL - 1
+    assert database.get_patron_borrow_count("555555") == 0
+    clock[0] += 2
+    assert database.get_patron_borrow_count("555555") == 1
+
+def test_init_database_migrates_old_borrow_records(tmp_path, monkeypatch):
+    """Databases created before due_ts/return_ts existed are backfilled on init."""
+    path = str(tmp_path / "old.db")
+    monkeypatch.setattr(database, "DATABASE", path)
+
+    returned_due = datetime(2025, 1, 1, 12, 0, 0)
+    returned_at = returned_due + timedelta(days=10, hours=3)
+    active_due = datetime(2025, 2, 20, 8, 0, 0)
+    now = datetime(2025, 3, 1, 9, 30, 0)
+
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE borrow_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patron_id TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            borrow_date TEXT NOT NULL,
+            due_date TEXT NOT NULL,
+            return_date TEXT
+        )
+    """)
+    conn.execute(
+        "INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date) VALUES (?, ?, ?, ?, ?)",
+        ("111111", 1, (returned_due - timedelta(days=14)).isoformat(), returned_due.isoformat(), returned_at.isoformat()),
+    )
+    conn.execute(
+        "INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date) VALUES (?, ?, ?, ?)",
+        ("111111", 2, (active_due - timedelta(days=14)).isoformat(), active_due.isoformat()),
+    )
+    conn.commit()
+    conn.close()
+
+    database.init_database()
+    try:
+        rows = database.get_db_connection().execute(
+            "SELECT due_ts, return_ts FROM borrow_records ORDER BY id"
+        ).fetchall()
+        assert [tuple(r) for r in rows] == [
+            (database.to_timestamp(returned_due), database.to_timestamp(returned_at)),
+            (database.to_timestamp(active_due), None),
+        ]
+
+        returned_fee = calculate_late_fee_for_book("111111", 1)
+        assert returned_fee["days_overdue"] == 10
+        assert returned_fee["fee_amount"] == 6.5
+
+        active_fee = calculate_late_fee_for_book("111111", 2, now=now)
+        assert active_fee["days_overdue"] == 9
+        assert active_fee["fee_amount"] == 5.5
+    finally:
+        database.close_db_connection()
+
+def test_late_fee_falls_back_to_text_dates(temp_db):
+    """Rows written without the integer columns still get the right fee."""
+    due = datetime(2025, 5, 1, 10, 0, 0)
+    returned_at = due + timedelta(days=12)
+    conn = database.get_db_connection()
+    conn.execute(
+        "INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date) VALUES (?, ?, ?, ?, ?)",
+        ("666666", 1, (due - timedelta(days=14)).isoformat(), due.isoformat(), returned_at.isoformat()),
+    )
+    conn.commit()
+
+    fee = calculate_late_fee_for_book("666666", 1)
+    assert fee["days_overdue"] == 12
+    assert fee["fee_amount"] == 8.5
+
+    # The return path and status report read the same fallback and agree with it
+    conn.execute(
+        "INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date) VALUES (?, ?, ?, ?)",
+        ("777777", 1, (due - timedelta(days=14)).isoformat(), due.isoformat()),
+    )
+    conn.commit()
+    database.invalidate_patron_loans("777777")
+    assert database.get_active_borrow("777777", 1)["due_ts"] == database.to_timestamp(due)
+    report = get_patron_status_report("777777")
+    assert report["borrowed_books"][0]["late_fee"] == calculate_late_fee_for_book("777777", 1)["fee_amount"]
+
+def test_borrow_unavailable_book(temp_db):
+    success, msg = borrow_book_by_patron("555555", 3)
+    assert success is False
+    assert "not available" in msg.lower()
+    assert database.get_book_by_id(3)["available_copies"] == 0
+
+def test_borrow_lost_race_reports_unavailable(temp_db, mocker):
+    # The availability check passes, but another borrower takes the last copy
+    # before the guarded decrement runs
+    mocker.patch("services.library_service.borrow_transaction", return_value=(False, True))
+    success, msg = borrow_book_by_patron("555555", 1)
+    assert success is False
+    assert msg == "This book is currently not available."